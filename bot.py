@@ -1,24 +1,32 @@
 import asyncio
+import functools
 import logging
+import multiprocessing
 import os
 import re
 import shutil
+import signal
 import subprocess
 import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from typing import Optional
 
 import img2pdf
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
+import PIL
+from PIL import Image, features
 
-from telegram import Update, InputFile
+from telegram import InputFile, Message, Update
+from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     ConversationHandler,
     ContextTypes,
+    TypeHandler,
     filters,
 )
 
@@ -29,6 +37,8 @@ logging.basicConfig(
 logger = logging.getLogger("pdf-converter-bot")
 
 WAIT_FILE, WAIT_NAME = range(2)
+# Seconds of inactivity after which a conversation ends and its files are removed
+CONVERSATION_TIMEOUT = int(os.getenv("CONVERSATION_TIMEOUT", "600"))
 
 IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".webp"}
 TEXT_EXTS = {".txt", ".md", ".log", ".csv"}
@@ -37,24 +47,89 @@ OFFICE_EXTS = {
     ".doc", ".docx", ".ppt", ".pptx", ".xls", ".xlsx",
     ".odt", ".ods", ".odp", ".rtf"
 }
+SUPPORTED_EXTS = IMAGE_EXTS | TEXT_EXTS | OFFICE_EXTS | {".pdf"}
+
+# Text -> PDF page layout
+A4 = (210 * 72 / 25.4, 297 * 72 / 25.4)  # points, same as reportlab's A4
+TEXT_MARGIN = 50
+TEXT_FONT_SIZE = 12
+TEXT_LINE_HEIGHT = 14
+TEXT_MAX_CHARS_PER_LINE = 95
+TEXT_LINES_PER_PAGE = int((A4[1] - 2 * TEXT_MARGIN) // TEXT_LINE_HEIGHT) + 1
+
+# Optional local telegram-bot-api server, e.g. http://127.0.0.1:8081.
+# The cloud Bot API only lets bots download files up to 20MB; a local server allows 2000MB
+# and hands out files as paths on its disk.
+BOT_API_URL = os.getenv("BOT_API_URL", "").rstrip("/")
+MAX_DOWNLOAD_MB = 2000 if BOT_API_URL else 20
+
+# Work dirs go to RAM (/dev/shm) when it's writable and has room, else the default temp dir.
+# Files bigger than MAX_TMPFS_MB are always handled on disk.
+SHM_DIR = "/dev/shm"
+TMP_ROOT = SHM_DIR if os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK) else None
+MAX_TMPFS_MB = int(os.getenv("MAX_TMPFS_MB", "64"))
+
+# CPU-bound rendering (reportlab, img2pdf) runs here so it doesn't hold the GIL of the bot process
+# forkserver: workers aren't forked from the bot process, which already runs threads
+EXECUTOR = ProcessPoolExecutor(
+    max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("forkserver")
+)
+# Max conversions running at once; further requests wait their turn
+MAX_CONCURRENT = int(os.getenv("MAX_CONCURRENT", "4"))
+SEM = asyncio.Semaphore(MAX_CONCURRENT)
+conversions_running = 0
+
+# Long-lived LibreOffice workers (unoserver), started with the application. Set LO_WORKERS=0
+# to spawn a fresh soffice for every conversion instead.
+LO_WORKERS = int(os.getenv("LO_WORKERS", "2"))
+LO_HOST = "127.0.0.1"
+LO_BASE_PORT = int(os.getenv("LO_BASE_PORT", "2003"))
+# unoserver gives up on (and restarts LibreOffice for) a conversion after this long;
+# shorter than the client timeout in convert_office_to_pdf
+LO_CONVERSION_TIMEOUT = 80
+
+# Free unoserver ports; None when no daemon is running
+lo_ports: Optional[asyncio.Queue] = None
+# port -> unoserver process / its LibreOffice profile dir
+lo_daemons: dict = {}
+lo_profiles: dict = {}
+lo_restarts: set = set()
+unoserver_path: Optional[str] = None
+unoconvert_path: Optional[str] = None
+
+# Converted PDFs keyed by Telegram file_unique_id (LRU), so files that are sent
+# again skip both the download and the conversion
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "64"))
+# The cache lives next to the work dirs (RAM when /dev/shm is used), so keep it small
+CACHE_MAX_MB = int(os.getenv("CACHE_MAX_MB", "128"))
+# key -> (path, size in bytes)
+CACHE: "OrderedDict[str, tuple]" = OrderedDict()
+cache_bytes = 0
+cache_dir: Optional[Path] = None
+
+_RE_PDF_EXT = re.compile(r"\.pdf$", re.IGNORECASE)
+_RE_BAD_CHARS = re.compile(r"[^A-Za-z0-9 _-]+")
+_RE_WHITESPACE = re.compile(r"\s+")
 
 def sanitize_filename(name: str, max_len: int = 64) -> str:
     name = name.strip()
     if not name:
         return "converted"
     # Remove extension if user typed ".pdf"
-    name = re.sub(r"\.pdf$", "", name, flags=re.IGNORECASE)
+    name = _RE_PDF_EXT.sub("", name)
     # Keep letters/numbers/space/_/-
-    name = re.sub(r"[^A-Za-z0-9 _-]+", "_", name)
-    name = re.sub(r"\s+", " ", name).strip()
+    name = _RE_BAD_CHARS.sub("_", name)
+    name = _RE_WHITESPACE.sub(" ", name).strip()
     if not name:
         name = "converted"
     return name[:max_len]
 
+@functools.lru_cache(maxsize=1)
 def find_soffice() -> Optional[str]:
     """
     Try to find LibreOffice 'soffice' executable.
     Works on Linux (soffice in PATH) and macOS default app install path.
+    The result is cached for the lifetime of the process.
     """
     # 1) PATH
     p = shutil.which("soffice") or shutil.which("libreoffice")
@@ -72,66 +147,408 @@ def find_soffice() -> Optional[str]:
 
     return None
 
-def convert_text_to_pdf(input_path: Path, pdf_path: Path) -> None:
-    # Simple text -> PDF (no fancy markdown rendering)
-    text = input_path.read_text(errors="ignore")
+def link_or_copy(src: Path, dst: Path) -> None:
+    """
+    Hardlink src to dst (no data copied), falling back to a real copy
+    when linking isn't possible (e.g. different filesystems).
+    """
+    if src == dst:
+        return
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        # Never copy over an existing file: it may be a hardlink someone else is reading
+        raise
+    except OSError:
+        # copyfile uses sendfile()/copy_file_range() in the kernel where available
+        shutil.copyfile(src, dst)
+
+def make_work_dir(file_size: Optional[int]) -> Path:
+    tmp_root = TMP_ROOT
+    if tmp_root:
+        # Room for the input, the PDF and LibreOffice's scratch files
+        needed = 3 * (file_size or 0)
+        too_big = file_size and file_size > MAX_TMPFS_MB * 1024 * 1024
+        if too_big or shutil.disk_usage(tmp_root).free < needed:
+            tmp_root = None
+    return Path(tempfile.mkdtemp(prefix="tg_pdf_", dir=tmp_root))
+
+def cache_get(key: str) -> Optional[Path]:
+    global cache_bytes
+    entry = CACHE.get(key)
+    if entry is None:
+        return None
+    path, size = entry
+    if not path.exists():
+        del CACHE[key]
+        cache_bytes -= size
+        return None
+    CACHE.move_to_end(key)
+    return path
+
+def cache_drop(key: str) -> None:
+    global cache_bytes
+    entry = CACHE.pop(key, None)
+    if entry is not None:
+        path, size = entry
+        cache_bytes -= size
+        path.unlink(missing_ok=True)
+
+def cache_put(key: str, pdf_path: Path) -> None:
+    # No awaits in here, so concurrent handlers can't interleave on the same key
+    global cache_dir, cache_bytes
+    if CACHE_MAX_ENTRIES <= 0 or key in CACHE:
+        return
+    st = pdf_path.stat()
+    size = st.st_size
+    if size > CACHE_MAX_MB * 1024 * 1024:
+        return
+    if cache_dir is None:
+        cache_dir = Path(tempfile.mkdtemp(prefix="tg_pdf_cache_", dir=TMP_ROOT))
+    if st.st_dev != cache_dir.stat().st_dev:
+        # Work dir fell back to another filesystem: a hardlink is impossible and
+        # a full copy would cost more than the cache saves
+        return
+
+    # Link under a temp name, then move into place atomically over any stale file
+    cached = cache_dir / f"{key}.pdf"
+    tmp = cache_dir / f"{key}.pdf.tmp"
+    try:
+        tmp.unlink(missing_ok=True)
+        os.link(pdf_path, tmp)
+        os.replace(tmp, cached)
+    except OSError as e:
+        # Caching is best-effort; never fail the user's conversion over it
+        logger.warning("Could not cache %s: %s", pdf_path, e)
+        tmp.unlink(missing_ok=True)
+        return
+    CACHE[key] = (cached, size)
+    cache_bytes += size
+
+    # Evict least recently used entries (and their files)
+    while len(CACHE) > CACHE_MAX_ENTRIES or cache_bytes > CACHE_MAX_MB * 1024 * 1024:
+        _, (old, old_size) = CACHE.popitem(last=False)
+        cache_bytes -= old_size
+        old.unlink(missing_ok=True)
+
+def wrap_text(text: str) -> list:
+    # Very simple wrapping
+    wrapped = []
+    for raw_line in text.splitlines():
+        line = raw_line.rstrip("\n")
+        # Slice into fixed-width chunks; an empty line still yields one (empty) chunk
+        wrapped.extend(
+            line[i:i + TEXT_MAX_CHARS_PER_LINE]
+            for i in range(0, max(len(line), 1), TEXT_MAX_CHARS_PER_LINE)
+        )
+    return wrapped
 
-    c = canvas.Canvas(str(pdf_path), pagesize=A4)
+def pdf_escape(s: str) -> str:
+    return s.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def write_text_pdf(lines: list, pdf_path: Path) -> None:
+    """
+    Write lines as a minimal PDF: built-in Helvetica, one content stream per page.
+    The whole file is assembled in memory and written with a single call.
+    Raises UnicodeEncodeError if a line can't be shown with Helvetica's WinAnsi encoding.
+    """
     width, height = A4
-    margin = 50
-    y = height - margin
-    line_height = 14
+    pages = [
+        lines[i:i + TEXT_LINES_PER_PAGE] for i in range(0, len(lines), TEXT_LINES_PER_PAGE)
+    ] or [[]]
+
+    buf = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+
+    def add_object(body: bytes) -> None:
+        offsets.append(len(buf))
+        buf.extend(b"%d 0 obj\n%s\nendobj\n" % (len(offsets), body))
+
+    # 1: catalog, 2: page tree, 3: font, then a (page, contents) pair per page
+    kids = " ".join(f"{4 + 2 * i} 0 R" for i in range(len(pages)))
+    add_object(b"<< /Type /Catalog /Pages 2 0 R >>")
+    add_object(f"<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>".encode())
+    add_object(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+
+    page_header = b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] " % (width, height)
+    for i, page_lines in enumerate(pages):
+        stream = bytearray(
+            b"BT /F1 %d Tf %d TL %d %.2f Td\n"
+            % (TEXT_FONT_SIZE, TEXT_LINE_HEIGHT, TEXT_MARGIN, height - TEXT_MARGIN)
+        )
+        for line in page_lines:
+            stream += b"(%s) Tj T*\n" % pdf_escape(line).encode("cp1252")
+        stream += b"ET"
 
-    # Very simple wrapping
-    max_chars_per_line = 95
+        add_object(page_header + b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (5 + 2 * i))
+        add_object(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
 
-    for raw_line in text.splitlines():
-        line = raw_line.rstrip("\n")
-        while len(line) > max_chars_per_line:
-            c.drawString(margin, y, line[:max_chars_per_line])
-            line = line[max_chars_per_line:]
-            y -= line_height
-            if y < margin:
-                c.showPage()
-                y = height - margin
-        c.drawString(margin, y, line)
-        y -= line_height
-        if y < margin:
-            c.showPage()
-            y = height - margin
+    xref_offset = len(buf)
+    buf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(offsets) + 1)
+    for offset in offsets:
+        buf += b"%010d 00000 n \n" % offset
+    buf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(offsets) + 1, xref_offset)
+
+    pdf_path.write_bytes(buf)
+
+def render_text_pdf_reportlab(lines: list, pdf_path: Path) -> None:
+    # Only imported when needed: reportlab is slow to import and rarely used now
+    from reportlab.pdfgen import canvas
+
+    c = canvas.Canvas(str(pdf_path), pagesize=A4)
+    height = A4[1]
+
+    # One text object per page instead of one drawString per line
+    for start in range(0, len(lines), TEXT_LINES_PER_PAGE):
+        text_obj = c.beginText(TEXT_MARGIN, height - TEXT_MARGIN)
+        text_obj.setFont("Helvetica", TEXT_FONT_SIZE, leading=TEXT_LINE_HEIGHT)
+        for line in lines[start:start + TEXT_LINES_PER_PAGE]:
+            text_obj.textLine(line)
+        c.drawText(text_obj)
+        c.showPage()
 
     c.save()
 
-def convert_image_to_pdf(input_path: Path, pdf_path: Path) -> None:
-    # img2pdf expects bytes
-    with open(input_path, "rb") as f_in:
-        img_bytes = f_in.read()
-    pdf_bytes = img2pdf.convert(img_bytes)
-    pdf_path.write_bytes(pdf_bytes)
-
-def convert_office_to_pdf(input_path: Path, out_dir: Path, timeout_sec: int = 90) -> Path:
-    soffice = find_soffice()
-    if not soffice:
-        raise RuntimeError(
-            "LibreOffice not found. Install LibreOffice, or make sure 'soffice' is available."
-        )
+def convert_text_to_pdf(input_path: Path, pdf_path: Path) -> None:
+    # Simple text -> PDF (no fancy markdown rendering)
+    text = input_path.read_text(errors="ignore")
+    lines = wrap_text(text)
+    try:
+        write_text_pdf(lines, pdf_path)
+    except UnicodeEncodeError:
+        # Characters outside WinAnsi (e.g. Cyrillic, emoji): fall back to reportlab
+        render_text_pdf_reportlab(lines, pdf_path)
+
+def log_image_backend() -> None:
+    # Pillow-SIMD versions look like "9.0.0.post1"
+    flavour = "Pillow-SIMD" if ".post" in PIL.__version__ else "Pillow"
+    turbo = features.check_feature("libjpeg_turbo")
+    logger.info("Image backend: %s %s (libjpeg-turbo: %s)", flavour, PIL.__version__, turbo)
 
+def convert_image_to_pdf(input_path: Path, pdf_path: Path) -> None:
+    if input_path.suffix.lower() == ".webp":
+        # img2pdf can't embed WebP as is: decode once with Pillow (SIMD / libjpeg-turbo
+        # when installed) and give img2pdf a JPEG it can embed without re-encoding.
+        # JPEG/PNG skip Pillow entirely.
+        jpg_path = input_path.with_name(input_path.name + ".jpg")
+        with Image.open(input_path) as im:
+            if im.mode in ("RGBA", "LA") or (im.mode == "P" and "transparency" in im.info):
+                # JPEG has no alpha: flatten onto white, or transparent areas turn black
+                rgba = im.convert("RGBA")
+                rgb = Image.new("RGB", rgba.size, (255, 255, 255))
+                rgb.paste(rgba, mask=rgba.getchannel("A"))
+            else:
+                rgb = im.convert("RGB")
+            rgb.save(jpg_path, "JPEG", quality=92, optimize=True)
+        input_path = jpg_path
+
+    # Let img2pdf read the file itself and write straight into the output file
+    with open(pdf_path, "wb") as f_out:
+        img2pdf.convert(str(input_path), outputstream=f_out)
+
+async def run_command(cmd: list, timeout_sec: int) -> None:
+    """
+    Run an external command without blocking the event loop.
+    Raises the same exceptions as subprocess.run(check=True, timeout=...).
+    """
+    # Own session so Ctrl+C / signals sent to the bot don't hit the child directly,
+    # and so a timeout can kill everything the command started
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True,
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout_sec)
+    except asyncio.TimeoutError:
+        # Kill the whole session: the soffice wrapper would otherwise leave soffice.bin
+        # running, holding the profile lock
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+        raise subprocess.TimeoutExpired(cmd, timeout_sec)
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output=stdout, stderr=stderr)
+
+async def wait_for_port(proc: asyncio.subprocess.Process, port: int, timeout_sec: int) -> bool:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout_sec
+    while loop.time() < deadline and proc.returncode is None:
+        try:
+            _, writer = await asyncio.open_connection(LO_HOST, port)
+        except OSError:
+            await asyncio.sleep(0.5)
+            continue
+        writer.close()
+        await writer.wait_closed()
+        return True
+    return False
+
+async def spawn_office_daemon(port: int) -> bool:
+    """
+    Start one unoserver on port (LibreOffice on port + 1) with a fresh profile.
+    Returns True once it accepts connections.
+    """
+    profile = Path(tempfile.mkdtemp(prefix=f"tg_pdf_lo_{port}_"))
+    lo_profiles[port] = profile
     cmd = [
-        soffice,
-        "--headless",
-        "--nologo",
-        "--nofirststartwizard",
-        "--norestore",
-        "--convert-to",
-        "pdf",
-        str(input_path),
-        "--outdir",
-        str(out_dir),
+        unoserver_path,
+        "--interface", LO_HOST,
+        "--port", str(port),
+        "--uno-port", str(port + 1),
+        "--executable", find_soffice(),
+        "--user-installation", str(profile),
+        "--conversion-timeout", str(LO_CONVERSION_TIMEOUT),
     ]
-
-    # Run conversion
-    logger.info("Running: %s", " ".join(cmd))
-    subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout_sec)
+    logger.info("Starting: %s", " ".join(cmd))
+    # Output goes to a file next to the profile, so a failed start can be diagnosed
+    # without a pipe that nobody drains
+    log_path = profile.with_name(profile.name + ".log")
+    with open(log_path, "wb") as log_file:
+        # Own session, so killing the group also takes down its soffice
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=log_file,
+            stderr=asyncio.subprocess.STDOUT,
+            start_new_session=True,
+        )
+    lo_daemons[port] = proc
+    if await wait_for_port(proc, port, timeout_sec=60):
+        return True
+    output = log_path.read_text(errors="replace").strip()[-2000:]
+    logger.warning("unoserver on port %d did not come up:\n%s", port, output or "(no output)")
+    return False
+
+async def kill_office_daemon(port: int, sig: int = signal.SIGKILL) -> None:
+    proc = lo_daemons.pop(port, None)
+    if proc is not None:
+        if proc.returncode is None:
+            try:
+                os.killpg(proc.pid, sig)
+            except ProcessLookupError:
+                pass
+        await proc.wait()
+    profile = lo_profiles.pop(port, None)
+    if profile is not None:
+        shutil.rmtree(profile, ignore_errors=True)
+        profile.with_name(profile.name + ".log").unlink(missing_ok=True)
+
+async def office_daemon_alive(port: int) -> bool:
+    proc = lo_daemons.get(port)
+    return proc is not None and proc.returncode is None and await wait_for_port(proc, port, timeout_sec=5)
+
+async def restart_office_daemon(port: int) -> None:
+    logger.warning("Restarting unoserver on port %d", port)
+    await kill_office_daemon(port)
+    await spawn_office_daemon(port)
+    # Back in the pool even if it failed to start: the next borrower retries
+    lo_ports.put_nowait(port)
+
+async def release_office_daemon(port: int, timed_out: bool) -> None:
+    """
+    Return a borrowed daemon to the pool. After a timeout its soffice may still be
+    stuck on the document, and after a failure it may have died: restart it in
+    the background in those cases so the next conversion gets a working one.
+    """
+    if not timed_out and await office_daemon_alive(port):
+        lo_ports.put_nowait(port)
+        return
+    task = asyncio.create_task(restart_office_daemon(port))
+    lo_restarts.add(task)
+    task.add_done_callback(lo_restarts.discard)
+
+async def start_office_daemons(app) -> None:
+    """
+    Start LO_WORKERS unoserver daemons (each owns one soffice with its own profile),
+    so office conversions don't pay the LibreOffice startup cost every time.
+    """
+    global lo_ports, unoserver_path, unoconvert_path
+
+    unoserver_path = shutil.which("unoserver")
+    unoconvert_path = shutil.which("unoconvert")
+    if LO_WORKERS <= 0 or not (unoserver_path and unoconvert_path and find_soffice()):
+        logger.info("LibreOffice daemons disabled, soffice will be started per conversion.")
+        return
+
+    ports = asyncio.Queue()
+    for i in range(LO_WORKERS):
+        port = LO_BASE_PORT + 2 * i
+        if await spawn_office_daemon(port):
+            ports.put_nowait(port)
+        else:
+            await kill_office_daemon(port)
+
+    if not ports.empty():
+        lo_ports = ports
+
+async def stop_office_daemons(app) -> None:
+    for task in list(lo_restarts):
+        task.cancel()
+    for port in list(lo_daemons):
+        await kill_office_daemon(port, signal.SIGTERM)
+
+async def shutdown(app) -> None:
+    await stop_office_daemons(app)
+    EXECUTOR.shutdown(cancel_futures=True)
+    if cache_dir is not None:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+async def convert_office_to_pdf(input_path: Path, out_dir: Path, timeout_sec: int = 90) -> Path:
+    if lo_ports is not None:
+        # Borrow an idle daemon; concurrent conversions wait for the next free one
+        port = await lo_ports.get()
+        timed_out = False
+        try:
+            if lo_daemons.get(port) is None or lo_daemons[port].returncode is not None:
+                # Died while idle (e.g. soffice crashed): bring it back before using it
+                await kill_office_daemon(port)
+                if not await spawn_office_daemon(port):
+                    raise RuntimeError("LibreOffice worker is unavailable, try again later.")
+            cmd = [
+                unoconvert_path,
+                "--host", LO_HOST,
+                "--port", str(port),
+                "--convert-to", "pdf",
+                str(input_path),
+                str(out_dir / (input_path.stem + ".pdf")),
+            ]
+            logger.info("Running: %s", " ".join(cmd))
+            await run_command(cmd, timeout_sec)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            raise
+        finally:
+            await release_office_daemon(port, timed_out)
+    else:
+        soffice = find_soffice()
+        if not soffice:
+            raise RuntimeError(
+                "LibreOffice not found. Install LibreOffice, or make sure 'soffice' is available."
+            )
+
+        cmd = [
+            soffice,
+            "--headless",
+            "--nologo",
+            "--nofirststartwizard",
+            "--norestore",
+            # Private profile: concurrent soffice runs on a shared profile hand off to
+            # each other or exit without writing anything
+            f"-env:UserInstallation={(out_dir / 'lo_profile').as_uri()}",
+            "--convert-to",
+            "pdf",
+            str(input_path),
+            "--outdir",
+            str(out_dir),
+        ]
+
+        # Run conversion
+        logger.info("Running: %s", " ".join(cmd))
+        await run_command(cmd, timeout_sec)
 
     # LibreOffice usually outputs: <same_basename>.pdf
     expected = out_dir / (input_path.stem + ".pdf")
@@ -139,36 +556,60 @@ def convert_office_to_pdf(input_path: Path, out_dir: Path, timeout_sec: int = 90
         return expected
 
     # Fallback: pick newest PDF in out_dir
-    pdfs = sorted(out_dir.glob("*.pdf"), key=lambda p: p.stat().st_mtime, reverse=True)
+    with os.scandir(out_dir) as entries:
+        pdfs = [e for e in entries if e.name.endswith(".pdf") and e.is_file()]
     if not pdfs:
         raise RuntimeError("LibreOffice conversion finished but no PDF was created.")
-    return pdfs[0]
+    # DirEntry caches its stat(), so each file is stat'ed at most once
+    return Path(max(pdfs, key=lambda e: e.stat().st_mtime).path)
 
-def convert_to_pdf(input_path: Path, work_dir: Path) -> Path:
+async def convert_to_pdf(input_path: Path, work_dir: Path) -> Path:
     ext = input_path.suffix.lower()
+    loop = asyncio.get_running_loop()
 
     pdf_path = work_dir / "output.pdf"
 
     if ext == ".pdf":
-        shutil.copyfile(input_path, pdf_path)
+        await asyncio.to_thread(link_or_copy, input_path, pdf_path)
         return pdf_path
 
     if ext in IMAGE_EXTS:
-        convert_image_to_pdf(input_path, pdf_path)
+        await loop.run_in_executor(EXECUTOR, convert_image_to_pdf, input_path, pdf_path)
         return pdf_path
 
     if ext in TEXT_EXTS:
-        convert_text_to_pdf(input_path, pdf_path)
+        await loop.run_in_executor(EXECUTOR, convert_text_to_pdf, input_path, pdf_path)
         return pdf_path
 
-    # Try LibreOffice for office formats (and other formats it can handle)
-    if ext in OFFICE_EXTS or True:
-        out_pdf = convert_office_to_pdf(input_path, work_dir)
-        # Standardize to output.pdf
-        shutil.copyfile(out_pdf, pdf_path)
+    # LibreOffice only for known office formats; anything else fails fast
+    if ext in OFFICE_EXTS:
+        out_pdf = await convert_office_to_pdf(input_path, work_dir)
+        # Standardize to output.pdf (same directory, so this is just a rename)
+        os.replace(out_pdf, pdf_path)
         return pdf_path
 
+    raise ValueError(f"Unsupported extension: {ext or '(none)'}")
+
+def discard_work_dir(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Drop a file the user uploaded but never converted
+    work_dir = context.user_data.get("work_dir")
+    if work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    context.user_data.clear()
+
+async def run_conversion(input_path: Path, work_dir: Path) -> Path:
+    # Logs how many conversions overlap, to confirm users aren't served one at a time
+    global conversions_running
+    conversions_running += 1
+    logger.info("Converting %s (%d running)", input_path.name, conversions_running)
+    try:
+        return await convert_to_pdf(input_path, work_dir)
+    finally:
+        conversions_running -= 1
+        logger.info("Finished %s (%d still running)", input_path.name, conversions_running)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    discard_work_dir(context)
     await update.message.reply_text(
         "Send me a file (document/photo). I’ll convert it to PDF.\n"
         "Then I’ll ask you what filename you want."
@@ -176,50 +617,84 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return WAIT_FILE
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data.clear()
+    discard_work_dir(context)
     await update.message.reply_text("Cancelled. Send /start to begin again.")
     return ConversationHandler.END
 
+async def conversation_timed_out(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    discard_work_dir(context)
+
 async def receive_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     msg = update.message
 
-    # Telegram Bot API getFile download limit is 20MB (standard bot API)
-    # We'll check known sizes and warn early.
+    # Telegram Bot API getFile download limit is 20MB (standard bot API),
+    # 2000MB with a local Bot API server. We'll check known sizes and warn early.
     file_id = None
+    file_unique_id = None
     original_name = None
     file_size = None
 
     if msg.document:
         doc = msg.document
         file_id = doc.file_id
+        file_unique_id = doc.file_unique_id
         original_name = doc.file_name or "file"
         file_size = doc.file_size
     elif msg.photo:
         # Take largest photo size
         photo = msg.photo[-1]
         file_id = photo.file_id
+        file_unique_id = photo.file_unique_id
         original_name = "photo.jpg"
         file_size = photo.file_size
     else:
         await msg.reply_text("Please send a document or a photo.")
         return WAIT_FILE
 
-    if file_size and file_size > 20 * 1024 * 1024:
+    # Reject unsupported types from metadata alone, before downloading anything
+    ext = Path(original_name).suffix.lower()
+    if ext not in SUPPORTED_EXTS:
+        await msg.reply_text(
+            f"Sorry, I can't convert '{ext or original_name}' files.\n"
+            f"Supported: {', '.join(sorted(SUPPORTED_EXTS))}"
+        )
+        return WAIT_FILE
+
+    if file_size and file_size > MAX_DOWNLOAD_MB * 1024 * 1024:
         await msg.reply_text(
-            "That file looks bigger than 20MB.\n"
-            "With the standard Telegram Bot API, bots can only download up to 20MB.\n"
+            f"That file looks bigger than {MAX_DOWNLOAD_MB}MB.\n"
+            f"This bot can only download files up to {MAX_DOWNLOAD_MB}MB.\n"
             "Please send a smaller file."
         )
         return WAIT_FILE
 
     # Prepare workspace for this user
-    work_dir = Path(tempfile.mkdtemp(prefix="tg_pdf_"))
+    work_dir = make_work_dir(file_size)
     input_path = work_dir / original_name
+    cached_pdf = cache_get(file_unique_id)
+
+    if cached_pdf:
+        # Converted this exact file before: reuse that PDF, no download or conversion
+        cached_input = work_dir / "cached.pdf"
+        try:
+            await asyncio.to_thread(link_or_copy, cached_pdf, cached_input)
+            input_path = cached_input
+        except OSError:
+            # Evicted by another conversion meanwhile: forget it and download as usual
+            cache_drop(file_unique_id)
+            cached_input.unlink(missing_ok=True)
+            cached_pdf = None
 
     try:
-        tg_file = await context.bot.get_file(file_id)
-        # download_to_drive(custom_path=...) is the modern PTB method  [oai_citation:3‡docs.python-telegram-bot.org](https://docs.python-telegram-bot.org/en/v22.1/telegram.file.html)
-        await tg_file.download_to_drive(custom_path=input_path)
+        if not cached_pdf:
+            tg_file = await context.bot.get_file(file_id)
+            local_path = Path(tg_file.file_path) if BOT_API_URL and tg_file.file_path else None
+            if local_path and local_path.is_absolute() and local_path.exists():
+                # Local Bot API server already stored the file on disk: link it, no download
+                await asyncio.to_thread(link_or_copy, local_path, input_path)
+            else:
+                # download_to_drive(custom_path=...) is the modern PTB method  [oai_citation:3‡docs.python-telegram-bot.org](https://docs.python-telegram-bot.org/en/v22.1/telegram.file.html)
+                await tg_file.download_to_drive(custom_path=input_path)
     except Exception as e:
         shutil.rmtree(work_dir, ignore_errors=True)
         await msg.reply_text(f"Failed to download your file: {e}")
@@ -228,6 +703,10 @@ async def receive_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     # Store paths for next step
     context.user_data["work_dir"] = str(work_dir)
     context.user_data["input_path"] = str(input_path)
+    context.user_data["original_name"] = original_name
+    context.user_data["file_id"] = file_id
+    if not cached_pdf:
+        context.user_data["file_unique_id"] = file_unique_id
     suggested = sanitize_filename(Path(original_name).stem)
 
     await msg.reply_text(
@@ -236,12 +715,32 @@ async def receive_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     )
     return WAIT_NAME
 
+async def reply_with_file_id(msg: Message, file_id: Optional[str]) -> bool:
+    """
+    Send an already-uploaded file back by its file_id (no download, no upload).
+    Returns False if Telegram rejected the file_id, so the caller can upload instead.
+    """
+    if not file_id:
+        return False
+    try:
+        await msg.reply_document(document=file_id)
+    except BadRequest as e:
+        # Only a definite rejection; on network errors/timeouts the document may
+        # already have been delivered, so those go to the normal error path
+        logger.info("Re-sending by file_id failed, uploading instead: %s", e)
+        return False
+    return True
+
 async def receive_name_and_convert(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     msg = update.message
     desired = sanitize_filename(msg.text or "")
 
     work_dir = Path(context.user_data.get("work_dir", ""))
     input_path = Path(context.user_data.get("input_path", ""))
+    file_unique_id = context.user_data.get("file_unique_id")
+    original_name = context.user_data.get("original_name")
+    file_id = context.user_data.get("file_id")
+    out_name = f"{desired}.pdf"
 
     if not work_dir.exists() or not input_path.exists():
         await msg.reply_text("I lost the file context. Send /start and upload again.")
@@ -251,12 +750,19 @@ async def receive_name_and_convert(update: Update, context: ContextTypes.DEFAULT
     await msg.reply_text("Converting… ⏳")
 
     try:
-        pdf_path = convert_to_pdf(input_path, work_dir)
-
-        out_name = f"{desired}.pdf"
-        with open(pdf_path, "rb") as f:
-            await msg.reply_document(document=InputFile(f, filename=out_name))
-            # InputFile supports custom filename  [oai_citation:4‡docs.python-telegram-bot.org](https://docs.python-telegram-bot.org/en/v21.7/telegram.inputfile.html?utm_source=chatgpt.com)
+        # A PDF whose name doesn't change can go back as-is by file_id. Telegram keeps
+        # the original file name on file_id re-sends, so a rename still needs an upload.
+        if original_name != out_name or not await reply_with_file_id(msg, file_id):
+            async with SEM:
+                pdf_path = await run_conversion(input_path, work_dir)
+            if file_unique_id:
+                cache_put(file_unique_id, pdf_path)
+
+            # Read in a thread: PTB would read a Path/file object synchronously on the loop.
+            # Uploading bytes also keeps filename= in local mode, where a Path becomes a
+            # bare file:// URI the server may not be allowed to read.
+            data = await asyncio.to_thread(pdf_path.read_bytes)
+            await msg.reply_document(document=InputFile(data, filename=out_name))
 
         await msg.reply_text("Done ✅ Send another file anytime.")
     except subprocess.TimeoutExpired:
@@ -280,21 +786,55 @@ def main() -> None:
     if not token:
         raise RuntimeError("Set BOT_TOKEN environment variable.")
 
-    app = ApplicationBuilder().token(token).build()
+    # Bigger connection pool so concurrent users' downloads/uploads reuse warm
+    # connections instead of queueing for the default handful of them
+    request = HTTPXRequest(
+        connection_pool_size=int(os.getenv("HTTP_POOL_SIZE", "32")),
+        read_timeout=60,
+        write_timeout=60,
+        # Requests that carry files (reply_document) use this instead of write_timeout;
+        # local mode allows files up to 2000MB
+        media_write_timeout=300 if BOT_API_URL else 60,
+        pool_timeout=5,
+        http_version="1.1",
+    )
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .request(request)
+        # Handle updates from different users in parallel; otherwise one user's
+        # conversion holds up everyone else's messages until it returns
+        .concurrent_updates(True)
+        .post_init(start_office_daemons)
+        .post_shutdown(shutdown)
+    )
+    if BOT_API_URL:
+        logger.info("Using local Bot API server at %s", BOT_API_URL)
+        builder = (
+            builder
+            .base_url(f"{BOT_API_URL}/bot")
+            .base_file_url(f"{BOT_API_URL}/file/bot")
+            .local_mode(True)
+        )
+    app = builder.build()
 
     conv = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={
             WAIT_FILE: [MessageHandler(filters.Document.ALL | filters.PHOTO, receive_file)],
             WAIT_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_name_and_convert)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timed_out)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
         allow_reentry=True,
+        # Abandoned uploads would otherwise sit in the work dir (RAM on /dev/shm) forever
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
 
     app.add_handler(conv)
     app.add_handler(CommandHandler("cancel", cancel))
 
+    log_image_backend()
     logger.info("Bot running...")
     app.run_polling()
 